@@ -5,41 +5,119 @@ __author__ = 'Domen Gorjup'
 Core of the Digital Image Correlation algorithm, implemented for use with the pyDIC application.
 '''
 
+import concurrent.futures
+import math
 import numpy as np
-import scipy.interpolate
+import scipy.fft
 import scipy.ndimage
-import scipy.signal
 
 
 def zncc(im1, im2):
     '''
     Calculate the zero normalized cross-correlation coefficient of input images.
+    Means, variances and covariance are derived from raw moment sums, without temporary zero-mean images.
 
     :param im1: First input image.
     :param im2: Second input image.
     :return: zncc ([0,1]). If 1, input images match perfectly.
     '''
-    nom = np.mean((im1-im1.mean())*(im2-im2.mean()))
-    den = im1.std()*im2.std()
-    if den == 0:
-        return 0
-    return nom/den
+    im1 = np.ravel(im1).astype(np.float64, copy=False)
+    im2 = np.ravel(im2).astype(np.float64, copy=False)
+    n = im1.size
+    m1, m2 = np.sum(im1)/n, np.sum(im2)/n
+    nom = np.dot(im1, im2)/n - m1*m2                    # Covariance from raw moment sums.
+    var = np.maximum([np.dot(im1, im1)/n - m1**2, np.dot(im2, im2)/n - m2**2], 0)   # Clip rounding errors.
+    den = np.sqrt(var[0] * var[1])
+    return float(np.divide(nom, den, out=np.zeros(()), where=den != 0))  # 0 if an image is constant.
 
 
 def get_initial_guess(target, roi_image):
     '''
     Get initial guess for subset ROI position in targer image, using FFT based  zero-mean cross correlation.
+    For repeated guesses with the same ROI image and target shape, use InitialGuessEngine directly.
 
     :param target: Target image as 2D numpy array.
     :param roi_image: Region of Interest image as 2D numpy array.
     :return: (y,x) of the estimated translation vector.
     '''
-    target = target - np.mean(target)
-    roi_image = roi_image[::-1, ::-1] - np.mean(roi_image)
+    return InitialGuessEngine(roi_image, target.shape)(target)
 
-    corr_fft = scipy.signal.fftconvolve(target, roi_image, mode='valid')
-    in_guess_fft = np.unravel_index(corr_fft.argmax(), corr_fft.shape)
-    return np.array(in_guess_fft, dtype=np.int), corr_fft
+
+class InitialGuessEngine:
+    '''
+    FFT based zero-mean cross correlation of a static ROI image with target images of a fixed shape.
+    The correlation is computed with real FFTs, zero-padded to a fast FFT size. Since only the 'valid' part
+    of the correlation is used, padding to the target image size suffices (no circular wrap-around).
+    The conjugate ROI spectrum is computed once, so each call only transforms the target image.
+    '''
+    def __init__(self, roi_image, target_shape):
+        '''
+        :param roi_image: Region of Interest image as 2D numpy array.
+        :param target_shape: Shape of the target images, (h, w).
+        '''
+        self.target_shape = tuple(target_shape)
+        self.fshape = [scipy.fft.next_fast_len(n, real=True) for n in self.target_shape]
+        self.valid_shape = tuple(np.subtract(self.target_shape, roi_image.shape) + 1)
+        roi_image = roi_image - np.mean(roi_image)
+        self.F_roi_conj = scipy.fft.rfft2(roi_image, s=self.fshape, workers=-1).conj()
+
+    def __call__(self, target):
+        '''
+        :param target: Target image as 2D numpy array.
+        :return: (y,x) of the estimated translation vector.
+        '''
+        if target.shape != self.target_shape:
+            raise ValueError('Target image shape {} does not match {}!'.format(target.shape, self.target_shape))
+        target = target - np.mean(target)
+        F_target = scipy.fft.rfft2(target, s=self.fshape, workers=-1)
+        corr = scipy.fft.irfft2(F_target * self.F_roi_conj, s=self.fshape, workers=-1)
+        corr_fft = corr[:self.valid_shape[0], :self.valid_shape[1]]
+        in_guess_fft = np.unravel_index(corr_fft.argmax(), corr_fft.shape)
+        return np.array(in_guess_fft, dtype=int), corr_fft
+
+
+_spectral_cache = {}
+
+
+def _spectral_derivative_kernels(shape):
+    '''
+    Returns the (cached) Fourier domain derivative multipliers for real FFTs of an image of given shape.
+    Nyquist components are zeroed, so the derivative of a real image stays real.
+
+    :param shape: Shape of the (mirror-extended) image, (h, w).
+    :return: (kx, ky): Multipliers of the rfft2 spectrum for the derivative in x and y direction.
+    '''
+    shape = tuple(shape)
+    kernels = _spectral_cache.get(shape)
+    if kernels is None:
+        h, w = shape
+        ky = 2j*np.pi * scipy.fft.fftfreq(h)[:, None]
+        kx = 2j*np.pi * scipy.fft.rfftfreq(w)[None, :]
+        if h % 2 == 0:
+            ky[h//2] = 0
+        if w % 2 == 0:
+            kx[:, -1] = 0
+        kernels = (kx, ky)
+        _spectral_cache[shape] = kernels
+    return kernels
+
+
+def _spectral_gradient(image):
+    '''
+    Computes the gradient of input image in the Fourier domain. The image is mirror-extended to twice its size
+    before the transform, so it is periodic and continuous at the borders (no ringing at the ROI edges).
+    The sign follows the central_fd convolution convention of get_gradient.
+
+    :param image: Image to compute gradient of.
+    :return: [gx, gy] (numpy array): Gradient images with respect to x and y direction.
+    '''
+    h, w = image.shape
+    extended = np.pad(image, ((0, h), (0, w)), mode='symmetric')
+    kx, ky = _spectral_derivative_kernels(extended.shape)
+    F = scipy.fft.rfft2(extended, workers=-1)
+    g_x = scipy.fft.irfft2(F * -kx, s=extended.shape, workers=-1)[:h, :w]
+    g_y = scipy.fft.irfft2(F * -ky, s=extended.shape, workers=-1)[:h, :w]
+    return np.stack([g_x, g_y])
 
 
 def get_gradient(image, kernel='central_fd', prefilter_gauss=True):
@@ -48,10 +126,14 @@ def get_gradient(image, kernel='central_fd', prefilter_gauss=True):
 
     :param image: Image to compute gradient of.
     :param kernel: Tuple of convolution kernels in x and y direction. Central finite difference used if left blank.
+        If 'spectral', the gradient is computed in the Fourier domain (see _spectral_gradient).
     :param prefilter_gauss: If True, the gradient kernel is first filtered with a Gauss filter to eliminate noise.
+        Not used with the 'spectral' gradient.
     :return: [gx, gy] (numpy array): Gradient images with respect to x and y direction.
     '''
-    if kernel == 'central_fd':
+    if isinstance(kernel, str) and kernel == 'spectral':
+        return _spectral_gradient(np.asarray(image, dtype=np.float64))
+    elif isinstance(kernel, str) and kernel == 'central_fd':
         if prefilter_gauss:
             #x_kernel = np.array([[-0.14086616, -0.20863973,  0.,  0.20863973,  0.14086616]])
             x_kernel = np.array([[-0.44637882,  0.        ,  0.44637882]])
@@ -65,135 +147,202 @@ def get_gradient(image, kernel='central_fd', prefilter_gauss=True):
     else:
         raise ValueError('Please input valid gradient convolution kernels!')
 
-    g_x = scipy.signal.convolve2d(image, x_kernel, mode='same')
-    g_y = scipy.signal.convolve2d(image, y_kernel, mode='same')
-    return np.array([g_x, g_y], dtype=np.float64)
+    image = np.asarray(image, dtype=np.float64)
+    g_x = _convolve_same(image, x_kernel)
+    g_y = _convolve_same(image, y_kernel)
+    return np.stack([g_x, g_y])
+
+
+def _convolve_same(image, kernel):
+    '''
+    Convolves the image with a 2D kernel, zero padded at the edges and centered as scipy.signal.convolve2d
+    with mode='same'. Single row or column kernels are applied as a (faster) 1D correlation with the
+    reversed kernel.
+
+    :param image: Image to convolve (float64).
+    :param kernel: 2D convolution kernel.
+    :return: Convolved image of the input image shape.
+    '''
+    kernel = np.asarray(kernel, dtype=np.float64)
+    if kernel.shape[0] == 1:
+        return scipy.ndimage.correlate1d(image, kernel[0, ::-1], axis=1, mode='constant')
+    elif kernel.shape[1] == 1:
+        return scipy.ndimage.correlate1d(image, kernel[::-1, 0], axis=0, mode='constant')
+    origin = [-1 if n % 2 == 0 else 0 for n in kernel.shape]    # convolve2d centering of even-sized kernels.
+    return scipy.ndimage.convolve(image, kernel, mode='constant', origin=origin)
 
 
 def jacobian_rigid(h, w):
     '''
     Returns the jacobian of a rigid body (only translations and rotations) affine wrap function with 3 parameters.
-    All elements are structured in the original ROI shape, to allow for simple summation later in the process.
+    Constant elements are scalars, coordinate-dependent elements are a row (x) or column (y) vector, which
+    broadcast to the original ROI shape, so no full-size constant images are allocated.
 
     :param h: Height of the ROI, used for parameter optimization.
     :param w: Width of the ROI, used for parameter optimization.
-    :return: jac (2x3 numpy array: Jacobian matrix of a 3-parameter affine warp function.
+    :return: jac (2x3 nested tuple): Jacobian matrix of a 3-parameter affine warp function.
 
         jac = [[dWx/dp1, dWx/dp2, dWx/dp3],
                [dWy/dp1, dWy/dp2, dWy/dp3]]
         (p1 = vy, p2 = ux, p2 = phi)
     '''
-    ones = np.ones((h, w), dtype=np.float64)
-    zeros = np.zeros((h, w), dtype=np.float64)
-    x,y = np.meshgrid(np.arange(w).astype(np.float64), np.arange(h).astype(np.float64))
-    jac = np.array([[zeros, ones, -y],
-                    [ones, zeros, x]])
+    x = np.arange(w, dtype=np.float64)[None, :]
+    y = np.arange(h, dtype=np.float64)[:, None]
+    jac = ((0., 1., -y),
+           (1., 0., x))
     return jac
 
 
 def jacobian_affine(h, w):
     '''
     Returns the Jacobian of a 6-parameter affine wrap function.
-    All elements are structured in the original ROI shape, to allow for simple summation later in the process.
+    Constant elements are scalars, coordinate-dependent elements are a row (x) or column (y) vector, which
+    broadcast to the original ROI shape, so no full-size constant images are allocated.
 
     :param h: Height of the ROI, used for parameter optimization.
     :param w: Width of the ROI, used for parameter optimization.
-    :return: jac (2x6 numpy array: Jacobian matrix of a 6-parameter affine warp function.
+    :return: jac (2x6 nested tuple): Jacobian matrix of a 6-parameter affine warp function.
 
         jac = [[dWx/dp1, dWx/dp2, dWx/dp3, dWx/dp4, dWx/dp5, dWx/dp6],
                [dWy/dp1, dWy/dp2, dWy/dp3, dWy/dp4, dWy/dp5, dWy/dp6]]
         (p1=du/dx, p2=du/dy, p3=u, p4=dv/dx, p5=dv/dy, p6=v)
     '''
-    ones = np.ones((h, w), dtype=np.float64)
-    zeros = np.zeros((h, w), dtype=np.float64)
-    x,y = np.meshgrid(np.arange(w).astype(np.float64), np.arange(h).astype(np.float64))
-    jac = np.array([[x, y, ones, zeros, zeros, zeros],
-                    [zeros, zeros, zeros, x, y, ones]])
+    x = np.arange(w, dtype=np.float64)[None, :]
+    y = np.arange(h, dtype=np.float64)[:, None]
+    jac = ((x, y, 1., 0., 0., 0.),
+           (0., 0., 0., x, y, 1.))
     return jac
 
 
 def sd_images(grad, jac):
     '''
     Calculates the steepest descent images - the product of a given gradient and jacobian.
-    Shaped(1, n_param), where n_param is the number of transformation parameters.
+    Each steepest descent image is stored flattened, as a contiguous row of the output array.
+    Jacobian elements may be scalars or arrays, broadcastable to the gradient image shape. Zero
+    elements are skipped.
 
     :param grad: Gradient vector of initial ROI.
     :param jac: Jacobian matrix of the warp function.
-    :return: sd_images: Array of steepest-descent images.
+    :return: sd_images: Array of flattened steepest-descent images, shaped (n_param, h*w), where n_param is
+        the number of transformation parameters.
     '''
     gx, gy = grad
     jx, jy = jac
-    sd_x = gx * jx
-    sd_y = gy * jy
-    sd_image = sd_x + sd_y
-    return sd_image.astype(np.float64)
+    n_param = len(jx)
+    sd_image = np.empty((n_param, gx.size), dtype=np.float32)
+    for k in range(n_param):
+        row = sd_image[k].reshape(gx.shape)
+        terms = [(g, j) for g, j in ((gx, jx[k]), (gy, jy[k])) if np.ndim(j) or j != 0]
+        if not terms:
+            row[...] = 0
+            continue
+        np.multiply(*terms[0], out=row)
+        for g, j in terms[1:]:
+            row += g * j
+    return sd_image
 
 
 def hessian(sd_im, n_param):
     '''
     Calculates the symmetric Hessian matrix form given steepest descent images.
-    Performs the 'dot product' sd_im.T * sd_im, multiplying the elements of steepest
-    descent images element-wise, to easily perform a summation over all coordinates.
+    Performs the dot product sd_im.T * sd_im as a single matrix product of the flattened
+    steepest descent images, summing over all coordinates.
 
-    :param sd_im: Steepest-descent images array of initial ROI.
+    :param sd_im: Flattened steepest-descent images array of initial ROI, shaped (n_param, h*w).
     :param n_param: Number of warp function parameters.
     :return: H: Hessian matrix of second order partial derivatives for initial ROI.
     '''
-    H = np.zeros((n_param, n_param))
-    for i in range(n_param):
-        h1 = sd_im[i]
-        for j in range(n_param):
-            if j >= i :
-                h2 = sd_im[j]
-                H[i, j] = np.sum(h1*h2)
-            else:
-                H[i, j] = H[j, i]
-    return H.astype(np.float64)
+    H = np.einsum('ik,jk->ij', sd_im, sd_im, dtype=np.float64)    # Accumulate in double precision.
+    return H
 
 
-def rigid_transform_matrix(p):
+def _empty_warp_matrix(out):
+    '''
+    Returns the given 3x3 output buffer (or a new one, if None) with the last row set to [0, 0, 1].
+    '''
+    matrix = np.empty((3, 3), dtype=np.float64) if out is None else out
+    matrix[2, 0], matrix[2, 1], matrix[2, 2] = 0., 0., 1.
+    return matrix
+
+
+def rigid_transform_matrix(p, out=None):
     '''
     Given the three transformation parameters, returns the corresponding transformation matrix.
 
     :param p: Array of three transformation parameters.
         p = [y, x, phi]
+    :param out: Optional preallocated 3x3 array, to store the matrix in.
     :return: 3x3 matrix of the rigid-body (translations and rotation only) affine warp function.
     '''
-    matrix = np.array([[np.cos(p[2]), -np.sin(p[2]), p[1]],
-                    [np.sin(p[2]), np.cos(p[2]), p[0]],
-                    [0, 0, 1]], dtype=np.float64)
+    c, s = math.cos(p[2]), math.sin(p[2])
+    matrix = _empty_warp_matrix(out)
+    matrix[0, 0], matrix[0, 1], matrix[0, 2] = c, -s, p[1]
+    matrix[1, 0], matrix[1, 1], matrix[1, 2] = s, c, p[0]
+    return matrix
+
+
+def inverse_rigid_transform_matrix(p, out=None):
+    '''
+    Given the three transformation parameters, returns the inverse of the corresponding transformation matrix.
+    The inverse of a rigid-body transform is computed in closed form: [R.T, -R.T*t].
+
+    :param p: Array of three transformation parameters.
+        p = [y, x, phi]
+    :param out: Optional preallocated 3x3 array, to store the matrix in.
+    :return: 3x3 inverse matrix of the rigid-body (translations and rotation only) affine warp function.
+    '''
+    c, s = math.cos(p[2]), math.sin(p[2])
+    matrix = _empty_warp_matrix(out)
+    matrix[0, 0], matrix[0, 1], matrix[0, 2] = c, s, -c*p[1] - s*p[0]
+    matrix[1, 0], matrix[1, 1], matrix[1, 2] = -s, c, s*p[1] - c*p[0]
     return matrix
 
 
-def affine_transform_matrix(p):
+def affine_transform_matrix(p, out=None):
     '''
     Given the three transformation parameters, returns the corresponding transformation matrix.
 
     :param p: Array of three transformation parameters.
         p = [du/dx, du/dy, u, dv/dx, dv/dy, v]
+    :param out: Optional preallocated 3x3 array, to store the matrix in.
     :return: 3x3 matrix of the rigid-body (translations and rotation only) affine warp function.
     '''
-    matrix = np.array([[1+p[0], p[1], p[2]],
-                      [p[3], 1+p[4], p[5]],
-                      [0, 0, 1]], dtype=np.float64)
+    matrix = _empty_warp_matrix(out)
+    matrix[0, 0], matrix[0, 1], matrix[0, 2] = 1+p[0], p[1], p[2]
+    matrix[1, 0], matrix[1, 1], matrix[1, 2] = p[3], 1+p[4], p[5]
     return matrix
 
 
-def param_from_rt_matrix(matrix):
+def inverse_affine_transform_matrix(p, out=None):
+    '''
+    Given the six transformation parameters, returns the inverse of the corresponding transformation matrix.
+
+    :param p: Array of six transformation parameters.
+        p = [du/dx, du/dy, u, dv/dx, dv/dy, v]
+    :param out: Optional preallocated 3x3 array, to store the matrix in.
+    :return: 3x3 inverse matrix of the affine warp function.
+    '''
+    matrix = np.linalg.inv(affine_transform_matrix(p, out=out))
+    if out is not None:
+        out[...] = matrix
+        return out
+    return matrix
+
+
+def param_from_rt_matrix(matrix, out=None):
     '''
     Get array of transformation parameters from the rigid transform warp matrix.
 
     :param matrix: Transformation matrix with 3 parameters (y-translation, x-translation, clockwise rotation).
+    :param out: Optional preallocated array of length 3, to store the parameters in.
     :return: Array of transformation parameters.
         p = [vy, ux, phi]
     '''
-    vy = matrix[1, -1]
-    ux = matrix[0, -1]
-    try:
-        phi = np.arcsin(matrix[1, 0])
-    except ValueError:
-        phi = np.arccos(matrix[0, 0])
-    return np.array([vy, ux, phi], dtype=np.float64)
+    p = np.empty(3, dtype=np.float64) if out is None else out
+    p[0] = matrix[1, -1]
+    p[1] = matrix[0, -1]
+    p[2] = math.atan2(matrix[1, 0], matrix[0, 0])      # Valid in all quadrants.
+    return p
 
 
 def param_from_affine_matrix(matrix):
@@ -213,48 +362,94 @@ def param_from_affine_matrix(matrix):
     return np.array([p1, p2, p3, p4, p5, p6], dtype=np.float64)
 
 
-def coordinate_warp(matrix, output_shape):
+_xy_h_cache = {}
+
+
+def homogeneous_grid(output_shape):
+    '''
+    Returns the homogeneous coordinate grid [x, y, 1] of the given ROI shape, flattened to shape (3, h*w).
+    The grid is computed once per shape and cached, the returned array is read-only.
+
+    :param output_shape: Shape of ROI, (h, w).
+    :return: xy_h: Array of homogeneous coordinates of all ROI pixels.
+    '''
+    output_shape = tuple(output_shape)
+    xy_h = _xy_h_cache.get(output_shape)
+    if xy_h is None:
+        h, w = output_shape
+        xy_h = np.ones((3, h*w), dtype=np.float64)
+        xy_h[1::-1] = np.mgrid[0:h, 0:w].reshape(2, -1)    # mgrid yields (y, x)
+        xy_h.setflags(write=False)
+        _xy_h_cache[output_shape] = xy_h
+    return xy_h
+
+
+def coordinate_warp(matrix, output_shape, out=None, yx_rows=False):
     '''
     Wraps the initial coordinate set of given shape, with reference at (0,0), using the given transformation parameters.
 
-    :param matrix: x3 matrix of the affine warp function.
+    :param matrix: 3x3 matrix of the affine warp function.
     :param output_shape: Shape of ROI, used to produce the initial coordinate grid to transform.
+    :param out: Optional preallocated (2, h*w) array, to store the warped coordinates in.
+    :param yx_rows: If True, a single (2, h*w) array of (y, x) coordinate rows is returned instead, the layout
+        used by interpolate_warp (see its yx parameter), so no stacking copy is needed there.
     :return: Tuple of (x, y) coordinates of the warped ROI, at which gray values must then be interpolated.
     '''
-    h, w = output_shape
-    x_array = np.tile(np.arange(w), h)
-    y_array = np.repeat(np.arange(h), w)
-    xy_h = np.vstack((np.vstack((x_array, y_array)), np.ones(w*h))).astype(np.float64)
-    uv_h = np.dot(matrix, xy_h)
-    uv = uv_h[:-1]
+    xy_h = homogeneous_grid(output_shape)
+    if yx_rows:
+        return np.dot(matrix[1::-1], xy_h, out=out)         # Row-swapped warp yields (y, x) rows.
+    uv = np.dot(matrix[:2], xy_h, out=out)
     return uv[0], uv[1]
 
 
-def interpolate_warp(xi, yi, target, output_shape, spl=None, order=3):
+# Boundary mode of interpolation, must match the spline prefilter (the 'mirror' default of spline_filter).
+_spline_mode = 'mirror'
+
+
+def build_spline(target, order=3):
+    '''
+    Returns the B-spline coefficients of the target image, used for spline interpolation of given order.
+    The spline prefilter is costly, so it should be computed only once per target image and reused in all
+    optimization iterations.
+
+    :param target: The image to extract interpolated gray values from (the current, target image in DIC).
+    :param order: Order of spline interpolation. Default: 3.
+    :return: spl: Array of spline coefficients, used to compute gray values of target image.
+    '''
+    if order < 2:                                       # Linear (and nearest) interpolation needs no prefilter.
+        return np.asarray(target, dtype=np.float64)
+    spl = scipy.ndimage.spline_filter(target, order=order, output=np.float64)
+    return spl
+
+
+def interpolate_warp(xi, yi, spl, output_shape, order=3, out=None, yx=None):
     '''
-    Returns the subimage of target at persumably non-integer coordinates xi, yi, using bivariate spline
-    interpolatio of given order. The output is reshaped into the original ROI shape, specified in output_shape.
-    If spline object is given, only use it to compute gray values at (yi, xi).
+    Returns the subimage of target at persumably non-integer coordinates xi, yi, using the precomputed
+    spline coefficients of the target image (see build_spline). The output is reshaped into the original ROI
+    shape, specified in output_shape.
 
     :param xi: Array of x-axis coordiates, at which interpolated gray values are computed.
     :param yi: Array of y-axis coordiates, at which interpolated gray values are computed.
-    :param target: The image to extract interpolated gray values from (the current, target image in DIC).
+    :param spl: Array of spline coefficients, used to compute gray values of current image.
     :param output_shape: ROI shape, to which the resulting arrays are reshaped. Must match the input coordiante arrays.
-    :param spl: scipy.interpolate.RectBivariateSpline object, used to compute gray values of current image.
-    :param order: Order of bivariate spline interpolation. Default: 3.
+    :param order: Order of spline interpolation, must match the order used in build_spline. Default: 3.
+    :param out: Optional preallocated float32 array of output_shape, to store the warped ROI in.
+    :param yx: Optional (2, h*w) array of (y, x) coordinates (see coordinate_warp with yx_rows=True), used
+        instead of xi, yi (these can then be None).
     :return: Image of the new, warped ROI, extracted from target image at input coordinates.
     '''
-    if not spl:
-        h,w = target.shape
-        spl = scipy.interpolate.RectBivariateSpline(x=np.arange(h),
-                                                    y=np.arange(w),
-                                                    z=target,
-                                                    kx=order,
-                                                    ky=order,
-                                                    s=0)
-    values = spl.ev(yi, xi).astype(np.float64)
-    warped_ROI = values.reshape(output_shape)
-    return warped_ROI
+    if spl is None:
+        raise ValueError('Please input the spline coefficients of the target image (see build_spline)!')
+    output_shape = tuple(output_shape)
+    if out is None:
+        out = np.empty(output_shape, dtype=np.float32)
+    elif out.shape != output_shape or out.dtype != np.float32:
+        raise ValueError('The output array must be a float32 array of shape {}!'.format(output_shape))
+    if yx is None:
+        yx = np.stack((yi, xi))
+    scipy.ndimage.map_coordinates(spl, yx.reshape((2,) + output_shape), order=order, prefilter=False,
+                                  mode=_spline_mode, output=out)
+    return out
 
 
 def get_error_image(f, f_stats, g):
@@ -270,24 +465,44 @@ def get_error_image(f, f_stats, g):
     g_ = np.mean(g)
     sd_g = np.std(g)
     err_im = (f - f_) - sd_f/sd_g * (g - g_)
-    return err_im.astype(np.float64)
+    return err_im.astype(np.float32)
 
 
 def get_sd_error_vector(sd_im, error_im, n_param):
     '''
     Calculates the right-side vector of the warp parameter optimization equation system.
-    Performs the 'dot product' of sd_im.T and error_im , multiplying the elements of steepest
-    descent images element-wise, to easily perform a summation over all coordinates.
+    Performs the dot product of sd_im.T and error_im as a single matrix-vector product of the
+    flattened steepest descent images, summing over all coordinates.
 
-    :param sd_im: Steepest-descent images array of initial ROI.
+    :param sd_im: Flattened steepest-descent images array of initial ROI, shaped (n_param, h*w).
     :param error_im: Error image according to the Zero-Normalized Sum of Squares criterion.
     :param n_param: Number of warp function parameters.
     :return: Right-side vector of parameter optimization equation system.
     '''
-    b = np.zeros(n_param)
-    for i in range(n_param):
-        h1 = sd_im[i]
-        b[i] = np.sum(h1*error_im)
+    b = np.dot(sd_im, error_im.ravel().astype(sd_im.dtype))
+    return b.astype(np.float64)
+
+
+def get_znssd_error_vector(sd_im, f, f_stats, g, out=None):
+    '''
+    Computes the right-side vector of the warp parameter optimization equation system directly from the
+    warped ROI, fusing get_error_image and get_sd_error_vector. The error image is built in a single
+    buffer in-place, and the warped ROI statistics are taken from the same buffer.
+
+    :param sd_im: Flattened steepest-descent images array of initial ROI, shaped (n_param, h*w).
+    :param f: Reference Region Of Interest image.
+    :param f_stats: Mean and standard deviation of reference image gray values.
+    :param g: The current (target) ROI image, warped using the current transformation parameters p.
+    :param out: Optional preallocated array of ROI shape and sd_im dtype, used as the error image buffer.
+    :return: Right-side vector of parameter optimization equation system.
+    '''
+    f_, sd_f = f_stats
+    err_im = np.subtract(g, np.mean(g), out=out, dtype=sd_im.dtype)  # g - g_
+    sd_g = np.sqrt(np.einsum('i,i->', err_im.ravel(), err_im.ravel(), dtype=np.float64) / err_im.size)
+    err_im *= -sd_f / sd_g
+    err_im += f
+    err_im -= f_                                            # (f - f_) - sd_f/sd_g * (g - g_)
+    b = np.dot(sd_im, err_im.ravel())
     return b.astype(np.float64)
 
 
@@ -302,6 +517,136 @@ def warp_update(inv_H, b, warp):
     :return: The updated warp function transformation matrix.
     '''
     dp = np.dot(inv_H, b)
-    inverse_increment_warp = np.linalg.inv(rigid_transform_matrix(dp))
+    inverse_increment_warp = inverse_rigid_transform_matrix(dp)
     updated_warp = np.dot(warp, inverse_increment_warp)
     return updated_warp
+
+
+# Jacobian and increment warp inverse of the supported warp models.
+_warp_models = {'rigid': (jacobian_rigid, inverse_rigid_transform_matrix),
+                'affine': (jacobian_affine, inverse_affine_transform_matrix)}
+
+
+class DICReference:
+    '''
+    Loop-invariant quantities of the reference ROI image. These only depend on the reference ROI and are
+    computed once, then reused in all optimization iterations for all target images.
+    '''
+    def __init__(self, roi, model='rigid', prefilter_gauss=True, kernel='central_fd'):
+        '''
+        :param roi: Reference Region Of Interest image.
+        :param model: Warp function model, 'rigid' (3 parameters) or 'affine' (6 parameters).
+        :param prefilter_gauss: If True, the gradient kernel is first filtered with a Gauss filter to eliminate noise.
+        :param kernel: Gradient kernel, passed to get_gradient ('central_fd', 'spectral' or a tuple of kernels).
+        '''
+        if model not in _warp_models:
+            raise ValueError('Please input a valid warp model ({:s})!'.format(', '.join(_warp_models)))
+        self.model = model
+        self.roi = np.asarray(roi, dtype=np.float64)
+        self.shape = self.roi.shape
+        self.f_mean = np.mean(self.roi)
+        self.sd_f = np.std(self.roi)
+        self.f_stats = (self.f_mean, self.sd_f)
+        self.grad = get_gradient(self.roi, kernel=kernel, prefilter_gauss=prefilter_gauss)
+        self.jac = _warp_models[model][0](*self.shape)
+        self.n_param = len(self.jac[0])
+        self.sd_im = sd_images(self.grad, self.jac)
+        self.H = hessian(self.sd_im, self.n_param)
+        self.inv_H = np.linalg.inv(self.H)
+        self.xy_h = homogeneous_grid(self.shape)
+        # Scratch buffers, reused in every gauss_newton_step (a reference must not be shared between threads):
+        self._yx = np.empty((2, self.roi.size), dtype=np.float64)       # Warped coordinates, (y, x) rows.
+        self._warped = np.empty(self.shape, dtype=np.float32)           # Warped ROI image.
+        self._err = np.empty(self.shape, dtype=self.sd_im.dtype)        # Error image.
+
+
+def warp_roi(reference, spl, warp, order=3):
+    '''
+    Interpolates the warped ROI from the current (target) image, using the scratch buffers of the reference.
+
+    :param reference: DICReference object of the reference ROI.
+    :param spl: Array of spline coefficients of the current (target) image (see build_spline).
+    :param warp: The current warp function matrix.
+    :param order: Order of spline interpolation, must match the order used in build_spline. Default: 3.
+    :return: warped_roi: The warped ROI image. This is a scratch buffer of the reference, overwritten in the
+        next call (copy it to keep it).
+    '''
+    yx = coordinate_warp(warp, reference.shape, out=reference._yx, yx_rows=True)
+    return interpolate_warp(None, None, spl, reference.shape, order=order, out=reference._warped, yx=yx)
+
+
+def gauss_newton_increment(reference, warped_roi):
+    '''
+    Computes the optimal warp parameter increment according to the ZNSSD criterion.
+
+    :param reference: DICReference object of the reference ROI.
+    :param warped_roi: The current (target) ROI image, warped using the current warp function.
+    :return: dp: Parameter increment vector.
+    '''
+    b = get_znssd_error_vector(reference.sd_im, reference.roi, reference.f_stats, warped_roi, out=reference._err)
+    return np.dot(reference.inv_H, b)
+
+
+def gauss_newton_step(reference, spl, warp, order=3, warped_roi=None):
+    '''
+    Performs a single iteration of the inverse compositional Gauss-Newton optimization, according to the
+    ZNSSD criterion: warped ROI interpolation, error vector, parameter increment and warp update.
+
+    :param reference: DICReference object of the reference ROI.
+    :param spl: Array of spline coefficients of the current (target) image (see build_spline).
+    :param warp: The current warp function matrix to be updated.
+    :param order: Order of spline interpolation, must match the order used in build_spline. Default: 3.
+    :param warped_roi: Optional, already extracted warped ROI image. If None, it is interpolated from spl.
+    :return: updated_warp: The updated warp function transformation matrix.
+    :return: err: Norm of the parameter increment (convergence criterion).
+    :return: warped_roi: The warped ROI image, used in this iteration. If interpolated, this is a scratch
+        buffer of the reference, overwritten in the next step.
+    '''
+    if warped_roi is None:
+        warped_roi = warp_roi(reference, spl, warp, order=order)
+    dp = gauss_newton_increment(reference, warped_roi)
+    inverse_increment_warp = _warp_models[reference.model][1](dp)
+    updated_warp = np.dot(warp, inverse_increment_warp)
+    return updated_warp, np.linalg.norm(dp), warped_roi
+
+
+def batch_step(references, spl, warps, order=3, executor=None, workers=None):
+    '''
+    Performs a single Gauss-Newton iteration for multiple independent ROIs on the same target image, in a
+    pool of threads. The heavy lifting (BLAS products, spline interpolation) runs in compiled code, and every
+    reference has its own scratch buffers, so the ROIs can be processed concurrently.
+
+    :param references: List of DICReference objects (one per ROI, each must appear only once).
+    :param spl: Array of spline coefficients of the current (target) image (see build_spline).
+    :param warps: List of current warp function matrices, one for each reference.
+    :param order: Order of spline interpolation, must match the order used in build_spline. Default: 3.
+    :param executor: Executor used to run the steps. Pass the same executor on every iteration to avoid
+                     re-creating the threads. If None, a temporary ThreadPoolExecutor is used.
+    :param workers: Maximum number of worker threads of the temporary executor. If None, the
+                    ThreadPoolExecutor default is used. Ignored if executor is given.
+    :return: updated_warps: List of updated warp function transformation matrices. The warp of a failed ROI
+        is returned unchanged.
+    :return: errs: Array of parameter increment norms (convergence criteria), NaN for a failed ROI.
+    :return: errors: Dictionary of the exceptions raised by failed ROIs, by ROI index. A failed ROI (e.g. a
+        singular warp matrix) does not abort the steps of the other ROIs.
+    '''
+    if len(warps) != len(references):
+        raise ValueError('Please input one warp matrix for each reference!')
+    if len({id(reference) for reference in references}) != len(references):
+        raise ValueError('Each reference can only appear once, as it holds the scratch buffers of its step.')
+
+    def step(reference, warp):
+        try:
+            return gauss_newton_step(reference, spl, warp, order=order)[:2]
+        except Exception as e:                          # Singular warp matrix error handling.
+            return warp, e
+
+    if executor is None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(step, references, warps))
+    else:
+        results = list(executor.map(step, references, warps))
+    errors = {i: err for i, (warp, err) in enumerate(results) if isinstance(err, Exception)}
+    updated_warps = [warp for warp, err in results]
+    errs = np.array([np.nan if i in errors else err for i, (warp, err) in enumerate(results)], dtype=np.float64)
+    return updated_warps, errs, errors
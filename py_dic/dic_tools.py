@@ -11,7 +11,6 @@ import glob
 import numpy as np
 import scipy.ndimage
 import scipy.signal
-from scipy.interpolate import RectBivariateSpline
 import collections
 import matplotlib.pyplot as plt
 import warnings
@@ -280,7 +279,7 @@ def get_rigid_movement(mraw_path, roi_reference, roi_size, file_shape, progressB
     :param roi_size: ROI size, (h, w) [px].
     :param file_shape: Tuple, (ntotal, height, width) of images in .mraw file.
     :param tol: Convergence condition (maximum parameter iteration vector norm).
-    :param int_order: Bivariate spline interpolation order.
+    :param int_order: Spline interpolation order.
     :param increment: Only read every n-th image from sequence.
     :return: results: Numpy array, containing extracted data, shaped as [y, x, phi] arrays at given images.
     :return: iters: Array, number of iterations required to reach converegence for each image pair.
@@ -298,16 +297,11 @@ def get_rigid_movement(mraw_path, roi_reference, roi_size, file_shape, progressB
     F = memmap[0]                                           # Initial image of the sequence is only used once.
     roi_reference = np.asarray(roi_reference)
     ROI = _get_roi_image(F, roi_reference, roi_size)        # First ROI image, used for the initial guess.
-    ROI_st = (np.mean(ROI), np.std(ROI))                    # Mean and standard deviation of ROI gray values.
     if crop:
         crop_slice = _crop_with_border_slice(roi_reference, roi_size, crop)
         F = F[crop_slice]                                   # Crop the initial image.
     in_guess = dic.get_initial_guess(F, ROI)[0]             # Cross-correlation initial guess is only used once.
-    jac = dic.jacobian_rigid(roi_size[0], roi_size[1])      # The Jacobian is constant throughout the computation.
-    grad = dic.get_gradient(ROI)                            # Compute gradient images of ROI.
-    sd_im = dic.sd_images(grad, jac)                        # Steepest descent images for the current ROI.
-    H = dic.hessian(sd_im, n_param=3)                       # Hessian matrix for the current ROI.
-    inv_H = np.linalg.inv(H)                                # Inverse of Hessian.
+    reference = dic.DICReference(ROI, model='rigid')        # Jacobian, gradient, sd images and Hessian of the ROI are constant.
 
     results = np.array([[0, 0, 0]], dtype=np.float64)       # Initialize the results array.
     iters = np.array([], dtype=int)                         # Initialize array of iteration counters.
@@ -332,13 +326,7 @@ def get_rigid_movement(mraw_path, roi_reference, roi_size, file_shape, progressB
             roi_translation = np.zeros(2, dtype=int)
             G = memmap[i]
 
-        h, w = G.shape                                      # Get the shape of the current image for interpolation.
-        spl = RectBivariateSpline(x=np.arange(h),           # Calculate the bivariate spline interpolation of G.
-                                  y=np.arange(w),
-                                  z=G,
-                                  kx=int_order,
-                                  ky=int_order,
-                                  s=0)
+        spl = dic.build_spline(G, order=int_order)          # Calculate the spline coefficients of G.
 
         err = 1.                                            # Initialize the convergence condition.
         niter = 0                                           # Initialize optimization loop iteration counter.
@@ -349,23 +337,16 @@ def get_rigid_movement(mraw_path, roi_reference, roi_size, file_shape, progressB
                 warped_ROI = _get_roi_image(G, in_guess, roi_size)  # Since in_guess are integer, extract new ROI directly.
                 warp = dic.rigid_transform_matrix(p)            # Get the affine transformation matrix form initial p.
             else:                                               # Else, use last computed parameters, interpolate new ROI.
-                xi, yi = dic.coordinate_warp(warp, roi_size)    # Get warped coordinates to new ROI, using last optimal warp.
-                warped_ROI = dic.interpolate_warp(xi, yi,       # Compute new ROI image by interpolating the reference image
-                                                  target=G,
-                                                  output_shape=roi_size,
-                                                  spl=spl,
-                                                  order=int_order)
-            error_im = dic.get_error_image(ROI, ROI_st, warped_ROI)  # Compute error image, according to the ZNSSD criterion.
-            b = dic.get_sd_error_vector(sd_im, error_im, 3)     # Compute the right-side vector in the optimization system.
-            dp = np.dot(inv_H, b)                               # Compute the optimal transform parameters increment.
-            err = np.linalg.norm(dp)                            # Incremental parameter norm = convergence criterion.
-            dp_warp = dic.rigid_transform_matrix(dp)            # Construct the increment transformation matrix.
+                warped_ROI = dic.warp_roi(reference, spl, warp,  # Compute new ROI image by interpolating the reference image
+                                          order=int_order)
             try:                                                # Singular warp matrix error handling.
-                inverse_increment_warp = np.linalg.inv(dp_warp)     # Construct the inverse of increment warp materix.
-                warp = np.dot(warp, inverse_increment_warp)         # The updated iteration of warp matrix.
+                warp, err, warped_ROI = dic.gauss_newton_step(reference, spl, warp,  # Update the warp matrix.
+                                                              order=int_order,
+                                                              warped_roi=warped_ROI)
                 p = dic.param_from_rt_matrix(warp)                  # The updated iteration of transformation parameters.
             except Exception as e:
-                errors[i] = {'image':G, 'ROI':warped_ROI, 'message': e, 'warp_matrix': dp_warp}
+                err = np.linalg.norm(dic.gauss_newton_increment(reference, warped_ROI))  # Convergence criterion of the failed step.
+                errors[i] = {'image':G, 'ROI':np.copy(warped_ROI), 'message': e, 'warp_matrix': warp}
             niter += 1                                          # Update the optimization loop iteration counter.
 
         p_shift = np.array([roi_translation[0], roi_translation[1], 0.]) # ROI shift if cropping
@@ -405,7 +386,7 @@ def get_affine_deformations(mraw_path, roi_reference, roi_size, file_shape, prog
     :param roi_size: ROI size, (h, w) [px].
     :param file_shape: Tuple, (ntotal, height, width) of images in .mraw file.
     :param tol: Convergence condition (maximum parameter iteration vector norm).
-    :param int_order: Bivariate spline interpolation order.
+    :param int_order: Spline interpolation order.
     :param increment: Only read every n-th image from sequence.
     :param: crop: Border size to crop loaded images (if 0, do not crop).
     :param: debug: If True, display debug output.
@@ -422,16 +403,11 @@ def get_affine_deformations(mraw_path, roi_reference, roi_size, file_shape, prog
     # Precomputable stuff:
     F = memmap[0]                                           # Initial image of the sequence is only used once.
     ROI = _get_roi_image(F, roi_reference, roi_size)        # First ROI image, used for the initial guess.
-    ROI_st = (np.mean(ROI), np.std(ROI))                    # Mean and standard deviation of ROI gray values.
     if crop:
         crop_slice = _crop_with_border_slice(roi_reference, roi_size, crop)
         F = F[crop_slice]                                   # Crop the initial image.
     in_guess = dic.get_initial_guess(F, ROI)[0]             # Cross-correlation initial guess is only used once.
-    jac = dic.jacobian_affine(roi_size[0], roi_size[1])     # The Jacobian is constant throughout the computation.         ##
-    grad = dic.get_gradient(ROI, prefilter_gauss=True)      # Compute gradient images of ROI.
-    sd_im = dic.sd_images(grad, jac)                        # Steepest descent images for the current ROI.
-    H = dic.hessian(sd_im, n_param=6)                       # Hessian matrix for the current ROI.                          ##
-    inv_H = np.linalg.inv(H)                                # Inverse of Hessian.
+    reference = dic.DICReference(ROI, model='affine')       # Jacobian, gradient, sd images and Hessian of the ROI are constant.
 
     results = np.array([np.zeros(6, dtype=np.float64)])     # Initialize the results array.                                ##
     iters = np.array([], dtype=int)                         # Initialize array of iteration counters.
@@ -458,13 +434,7 @@ def get_affine_deformations(mraw_path, roi_reference, roi_size, file_shape, prog
             roi_translation = np.zeros(2, dtype=int)
             G = memmap[i]
 
-        h, w = G.shape                                      # Get the shape of the current image for interpolation.
-        spl = RectBivariateSpline(x=np.arange(h),           # Calculate cubic bivariate spline interpolation of G.
-                                  y=np.arange(w),
-                                  z=G,
-                                  kx=int_order,
-                                  ky=int_order,
-                                  s=0)
+        spl = dic.build_spline(G, order=int_order)          # Calculate cubic spline coefficients of G.
 
         err = 1.                                            # Initialize the convergence condition.
         niter = 0                                           # Initialize optimization loop iteration counter.
@@ -476,23 +446,16 @@ def get_affine_deformations(mraw_path, roi_reference, roi_size, file_shape, prog
                 warped_ROI = _get_roi_image(G, in_guess, roi_size)  # Since in_guess are integer, extract new ROI directly.          
                 warp = dic.affine_transform_matrix(p)           # Get the affine transformation matrix form initial p.               ##
             else:                                               # Else, use last computed parameters, interpolate new ROI.
-                xi, yi = dic.coordinate_warp(warp, roi_size)    # Get warped coordinates to new ROI, using last optimal warp.
-                warped_ROI = dic.interpolate_warp(xi, yi,       # Compute new ROI image by interpolating the reference image
-                                                  target=G,
-                                                  output_shape=roi_size,
-                                                  spl=spl,
-                                                  order=int_order)
-            error_im = dic.get_error_image(ROI, ROI_st, warped_ROI)  # Compute error image, according to the ZNSSD criterion.
-            b = dic.get_sd_error_vector(sd_im, error_im, 6)     # Compute the right-side vector in the optimization system.           ##
-            dp = np.dot(inv_H, b)                               # Compute the optimal transform parameters increment.
-            err = np.linalg.norm(dp)                            # Incremental parameter norm = convergence criterion.
-            dp_warp = dic.affine_transform_matrix(dp)           # Construct the increment transformation matrix.                      ##
+                warped_ROI = dic.warp_roi(reference, spl, warp,  # Compute new ROI image by interpolating the reference image
+                                          order=int_order)
             try:                                                # Singular warp matrix error handling.
-                inverse_increment_warp = np.linalg.inv(dp_warp)     # Construct the inverse of increment warp materix.
-                warp = np.dot(warp, inverse_increment_warp)         # The updated iteration of warp matrix.
-                p = dic.param_from_affine_matrix(warp)                  # The updated iteration of transformation parameters.         ##
+                warp, err, warped_ROI = dic.gauss_newton_step(reference, spl, warp,  # Update the warp matrix.
+                                                              order=int_order,
+                                                              warped_roi=warped_ROI)
+                p = dic.param_from_affine_matrix(warp)              # The updated iteration of transformation parameters.             ##
             except Exception as e:
-                errors[i] = {'image':G, 'ROI':warped_ROI, 'message': e, 'warp_matrix': dp_warp}
+                err = np.linalg.norm(dic.gauss_newton_increment(reference, warped_ROI))  # Convergence criterion of the failed step.
+                errors[i] = {'image':G, 'ROI':np.copy(warped_ROI), 'message': e, 'warp_matrix': warp}
             niter += 1                                          # Update the optimization loop iteration counter.
         
         p_shift = np.zeros(6, dtype=np.float64)